@@ -3,56 +3,103 @@ import pandas as pd
 from chaosmagpy import load_CHAOS_matfile
 from chaosmagpy.data_utils import mjd2000
 from viresclient import SwarmRequest
+import numpy as np
 import sys,os
+from datetime import datetime, timedelta
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from gg_to_geo import gg_to_geo
-from auxiliaryfunctions import distance_to_GPS, Kradius, DistJ, DfTime_func
+from auxiliaryfunctions import distance_to_GPS, distance_to_GPS_rad, Kradius, DfTime_func
 
+# Swarm columns used by the ST-IDW process. float32 (~7 significant digits) is more than enough for residuals of a few hundred nT
+# and distances of a few thousand km, and halves the memory the interpolation has to scan. Flags go from 0 to 255.
+SWARM_FLOAT_COLUMNS = ['Latitude', 'Longitude', 'F_res', 'N_res', 'E_res', 'C_res', 'Kp']
+SWARM_FLAG_COLUMNS = ['Flags_F', 'Flags_B']
+
+# Request template shared by the three satellites, built once at import time instead of on every Get_Swarm_residuals call.
+CHAOS_MODEL_EXPRESSION = '"CHAOS_MCO_MLI_MMA" = "CHAOS-Core" + "CHAOS-Static" + "CHAOS-MMA-Primary" + "CHAOS-MMA-Secondary"'
+# Every Swarm download is kept here, one file per period with the three satellites, keyed on the dates, sampling step and model,
+# so re-running a track does not go back to VirES.
+SWARM_CACHE_DIR = r'./temp_data/swarm_cache'
+# Column layout of the cached DFs, part of the cache key.
+SWARM_CACHE_SCHEMA = 'v1|'+','.join(SWARM_FLOAT_COLUMNS)+':float32|'+','.join(SWARM_FLAG_COLUMNS)+':uint8|epoch:int64'
+SWARM_SAMPLING_STEP = "PT30S"
+# Consecutive days are requested together, up to this many days in a single VirES request.
+SWARM_BATCH_DAYS = 7
+# Maximum number of VirES requests in flight at the same time (each period sends three, one per satellite). This is the
+# effective cap for Get_Swarm_residuals_dates, whatever its max_workers.
+SWARM_MAX_REQUESTS = 6
+_swarm_request_slots = threading.BoundedSemaphore(SWARM_MAX_REQUESTS)
+
+SWARM_RESIDUAL_COLUMNS = {"F_res_CHAOS_MCO_MLI_MMA":"F_res","B_NEC_res_CHAOS_MCO_MLI_MMA_N": "N_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_E":"E_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_C":"C_res"}
 
 # 0. Get the GPS track in a CSV format.
-# Input: csv file store in the data folder, validate if there is a altitute attribute.
+# The coordinate columns are read straight as float64, so pandas does not have to infer their type.
+# Input: csv file store in the data folder, validate if there is a altitute attribute. Optional strftime format of the DateTime column.
 # Output: GPS Data as pandas DF.
 
-def getGPSData(gpsfilename,Lat,Long,DateTime,altitude):
+def getGPSData(gpsfilename,Lat,Long,DateTime,altitude,date_format=None):
     
+    # With a known date_format (i.e '%d/%m/%Y %H:%M') the timestamps are parsed with that format instead of read_csv
+    # inferring it, cache=True parses every repeated timestamp only once.
+    parse_dates = [] if date_format else [DateTime]
+    # Both cases only differ on the altitude column, the rest of the processing is shared.
     if altitude == '':
-        nfp = pd.read_csv(gpsfilename, parse_dates=[0], encoding='utf-8', dayfirst=True, usecols=[Lat, Long, DateTime])
+        nfp = pd.read_csv(gpsfilename, parse_dates=parse_dates, cache_dates=True, encoding='utf-8', dayfirst=True, usecols=[Lat, Long, DateTime], dtype={Lat: np.float64, Long: np.float64})
         nfp['gpsAltitude'] = 0
-        nfp.rename(columns={Lat: 'gpsLat', Long: 'gpsLong', DateTime: 'gpsDateTime', altitude: 'gpsAltitude'}, inplace = True)
-        # Convert the gpsDateTime to datetime python object
-        nfp['gpsDateTime'] = pd.to_datetime(nfp['gpsDateTime'])
-        nfp['gpsDateTime'] = nfp['gpsDateTime'].map(lambda x: x.replace(second=0))
-        nfp['gpsLat'] = nfp['gpsLat'].astype(float)
-        nfp['gpsLong'] = nfp['gpsLong'].astype(float)
-        # Adding new column epoch, will be usefuel to compare the date&time o each gps point agains the gathered swmarm data points
-        nfp['epoch'] = nfp['gpsDateTime'].astype('int64')//1e9
-        nfp['epoch'] = nfp['epoch'].astype(int)
-        # Computing Date and Time columns
-        nfp['dates'] = nfp['gpsDateTime'].dt.date
-        nfp['times'] = nfp['gpsDateTime'].dt.time
+        nfp.rename(columns={Lat: 'gpsLat', Long: 'gpsLong', DateTime: 'gpsDateTime'}, inplace = True)
     else:
-        nfp = pd.read_csv(gpsfilename, parse_dates=[0], encoding='utf-8', dayfirst=True, usecols=[Lat, Long, DateTime, altitude])
+        nfp = pd.read_csv(gpsfilename, parse_dates=parse_dates, cache_dates=True, encoding='utf-8', dayfirst=True, usecols=[Lat, Long, DateTime, altitude], dtype={Lat: np.float64, Long: np.float64, altitude: np.float64})
         nfp.rename(columns={Lat: 'gpsLat', Long: 'gpsLong', DateTime: 'gpsDateTime', altitude: 'gpsAltitude'}, inplace = True)
         nfp.loc[(nfp['gpsAltitude'] < 0) | (nfp['gpsAltitude'].isnull()), 'gpsAltitude'] = 0
-        # Convert the gpsDateTime to datetime python object
-        nfp['gpsDateTime'] = pd.to_datetime(nfp['gpsDateTime'])
-        nfp['gpsDateTime'] = nfp['gpsDateTime'].map(lambda x: x.replace(second=0))
-        nfp['gpsLat'] = nfp['gpsLat'].astype(float)
-        nfp['gpsLong'] = nfp['gpsLong'].astype(float)
-        # Adding new column epoch, will be usefuel to compare the date&time o each gps point agains the gathered swmarm data points
-        nfp['epoch'] = nfp['gpsDateTime'].astype('int64')//1e9
-        nfp['epoch'] = nfp['epoch'].astype(int)
-        # Computing Date and Time columns
-        nfp['dates'] = nfp['gpsDateTime'].dt.date
-        nfp['times'] = nfp['gpsDateTime'].dt.time        
+    if date_format:
+        nfp['gpsDateTime'] = pd.to_datetime(nfp['gpsDateTime'], format=date_format, cache=True)
+    # gpsDateTime is already parsed, only the seconds are dropped.
+    nfp['gpsDateTime'] = nfp['gpsDateTime'].dt.floor('min')
+    # Adding new column epoch, will be usefuel to compare the date&time o each gps point agains the gathered swmarm data points
+    # Integer division of the int64 nanoseconds, no float round trip.
+    nfp['epoch'] = nfp['gpsDateTime'].astype('int64')//10**9
+    # Computing Date and Time columns
+    nfp['dates'] = nfp['gpsDateTime'].dt.date
+    nfp['times'] = nfp['gpsDateTime'].dt.time
     return nfp
 
+# 0b. Get the days of Swarm data needed to cover the GPS track: GPS_unique_dates
+# Points before 04:00 also need the previous day and points after 20:00 the next one.
+# Works on int64 day buckets, so only the unique days become datetime.date objects.
+# Input:  GPS DF from getGPSData
+# Output: sorted array of unique datetime.date
+
+def GPS_unique_dates(GPSData):
+    gpsDateTime = GPSData['gpsDateTime'].to_numpy(dtype='datetime64[ns]')
+    days = gpsDateTime.astype('datetime64[D]')
+    secs = (gpsDateTime - days).astype('timedelta64[s]').astype(np.int64)
+    early = secs < 4*3600
+    late = secs > 20*3600
+    alldays = np.concatenate([days, days[early] - 1, days[late] + 1])
+    return np.unique(alldays).astype(object)
+
 # 1. For each day in the trayectory, Get the Swarm Data and Residuals: Get_Swarm_and_residuals
 # Input:  Date and Time variables
 # Output: Swarm DF for each Sat, including the residuals, and Quality Flags.
 
 def Get_Swarm_residuals(startDateTime, endDateTime):
     
+    #0. A period already downloaded is read back from SWARM_CACHE_DIR, already processed. The key includes the column layout
+    # (SWARM_CACHE_SCHEMA), so a change of columns or dtypes does not serve old pickles. A file that cannot be read (i.e a
+    # download interrupted by an older version) is removed and the period is downloaded again.
+    cache_key = hashlib.sha1((str(startDateTime)+'|'+str(endDateTime)+'|'+SWARM_SAMPLING_STEP+'|'+CHAOS_MODEL_EXPRESSION+'|'+SWARM_CACHE_SCHEMA).encode()).hexdigest()
+    cache_file = os.path.join(SWARM_CACHE_DIR, cache_key+'.pkl')
+    if os.path.exists(cache_file):
+        try:
+            return pd.read_pickle(cache_file)
+        except Exception:
+            print("Unreadable Swarm cache file, downloading the period again:", cache_file)
+            os.remove(cache_file)
+    
     requestA = SwarmRequest()
     requestB = SwarmRequest()
     requestC = SwarmRequest()
@@ -68,22 +115,13 @@ def Get_Swarm_residuals(startDateTime, endDateTime):
         ],
 
         models = [
-            
-            '"CHAOS_MCO_MLI_MMA" = "CHAOS-Core" + "CHAOS-Static" + "CHAOS-MMA-Primary" + "CHAOS-MMA-Secondary"'
+            CHAOS_MODEL_EXPRESSION
         ],
         auxiliaries=['Kp'],
         residuals=True, #Brining the residuals.
-        sampling_step="PT30S", #Get the data every 60 seconds. 
+        sampling_step=SWARM_SAMPLING_STEP, #Get the data every 60 seconds. 
     )
    
-    #Define an pandas dataframe to store the data request for Satellite A, based on the start Date and time.
-    #You can display dsA to get an idea of how the data is requested.
-    dsA = requestA.get_between(
-        start_time=startDateTime,
-        end_time=endDateTime, 
-        show_progress = False,
-        asynchronous = False
-    ).as_dataframe(expand=True)
     ### End Request for Sat A
     
     ### 2. Request for Sat Bravo, same request parameters defined by Satelite Alpha
@@ -97,20 +135,12 @@ def Get_Swarm_residuals(startDateTime, endDateTime):
 
         ],
         models = [
-            
-            '"CHAOS_MCO_MLI_MMA" = "CHAOS-Core" + "CHAOS-Static" + "CHAOS-MMA-Primary" + "CHAOS-MMA-Secondary"'
+            CHAOS_MODEL_EXPRESSION
         ],
         auxiliaries=['Kp'],
         residuals=True, 
-        sampling_step="PT30S",
+        sampling_step=SWARM_SAMPLING_STEP,
     )
-
-    dsB = requestB.get_between(
-        start_time= startDateTime,
-        end_time= endDateTime,
-        show_progress = False,
-        asynchronous = False
-    ).as_dataframe(expand=True)
     ### End Request for Sat B
     
     ## 3. Request for Sat Charlie.
@@ -124,48 +154,96 @@ def Get_Swarm_residuals(startDateTime, endDateTime):
 
         ],
         models = [
-            
-            '"CHAOS_MCO_MLI_MMA" = "CHAOS-Core" + "CHAOS-Static" + "CHAOS-MMA-Primary" + "CHAOS-MMA-Secondary"'
+            CHAOS_MODEL_EXPRESSION
         ],
         auxiliaries=['Kp'],
         residuals=True,
-        sampling_step="PT30S",
+        sampling_step=SWARM_SAMPLING_STEP,
     )
-
-    dsC = requestC.get_between(
-        start_time=startDateTime,
-        end_time=endDateTime,
-        show_progress = False,
-        asynchronous = False
-    ).as_dataframe(expand=True) 
     ### End Request for Sat C
     
-    ##4. Renaming Geomagnetic components columns.
-    dsA.rename(columns={"F_res_CHAOS_MCO_MLI_MMA":"F_res","B_NEC_res_CHAOS_MCO_MLI_MMA_N": "N_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_E":"E_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_C":"C_res"}, inplace = True)
-    dsB.rename(columns={"F_res_CHAOS_MCO_MLI_MMA":"F_res","B_NEC_res_CHAOS_MCO_MLI_MMA_N": "N_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_E":"E_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_C":"C_res"}, inplace = True)
-    dsC.rename(columns={"F_res_CHAOS_MCO_MLI_MMA":"F_res","B_NEC_res_CHAOS_MCO_MLI_MMA_N": "N_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_E":"E_res", "B_NEC_res_CHAOS_MCO_MLI_MMA_C":"C_res"}, inplace = True)
-    
-    #5. Add the epoch column, and set that as the pandas DF index. Useful to get an ID for each date and time.
-    dsA['epoch'] = dsA.index
-    dsA['timestamp'] = dsA.index
-    dsA['epoch'] = dsA['epoch'].astype('int64')//1e9
-    dsA['epoch'] = dsA['epoch'].astype(int)
-    dsA.set_index("epoch", inplace=True)
-    
-    dsB['epoch'] = dsB.index
-    dsB['timestamp'] = dsB.index
-    dsB['epoch'] = dsB['epoch'].astype('int64')//1e9
-    dsB['epoch'] = dsB['epoch'].astype(int)
-    dsB.set_index("epoch", inplace=True)
-        
-    dsC['epoch'] = dsC.index
-    dsC['timestamp'] = dsC.index
-    dsC['epoch'] = dsC['epoch'].astype('int64')//1e9
-    dsC['epoch'] = dsC['epoch'].astype(int)
-    dsC.set_index("epoch", inplace=True)
+    ## 4. Send the three requests at the same time, they are independent and most of their time is spent waiting on the VirES server.
+    #Each request returns a pandas dataframe with the data for one satellite, based on the start Date and time.
+    #You can display dsA to get an idea of how the data is requested.
+    # get_between holds one of the SWARM_MAX_REQUESTS slots, so the VirES server never sees more requests at once from this
+    # process, whatever the number of threads in Get_Swarm_residuals_dates.
+    def get_dataframe(request):
+        with _swarm_request_slots:
+            data = request.get_between(
+                start_time=startDateTime,
+                end_time=endDateTime,
+                show_progress = False,
+                asynchronous = False
+            )
+        return data.as_dataframe(expand=True)
+    
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        dsA, dsB, dsC = executor.map(get_dataframe, [requestA, requestB, requestC])
+    
+    ##5. Renaming Geomagnetic components columns.
+    dsA.rename(columns=SWARM_RESIDUAL_COLUMNS, inplace = True)
+    dsB.rename(columns=SWARM_RESIDUAL_COLUMNS, inplace = True)
+    dsC.rename(columns=SWARM_RESIDUAL_COLUMNS, inplace = True)
+    
+    #6. Downcast the columns used by the ST-IDW process. epoch keeps its int64 type.
+    for ds in (dsA, dsB, dsC):
+        ds[SWARM_FLOAT_COLUMNS] = ds[SWARM_FLOAT_COLUMNS].astype(np.float32)
+        ds[SWARM_FLAG_COLUMNS] = ds[SWARM_FLAG_COLUMNS].astype(np.uint8)
+    
+    #7. Add the epoch (int64 seconds) as the pandas DF index, computed straight from the int64 nanoseconds of the DatetimeIndex.
+    # Useful to get an ID for each date and time, and the time windows are then plain int64 comparisons.
+    for ds in (dsA, dsB, dsC):
+        ds['timestamp'] = ds.index
+        ds.index = pd.Index(ds.index.asi8 // 10**9, name='epoch')
+    
+    #8. Keep the three satellites in a single cache file for this period.
+    # Written to a temporary file first and then moved in place, so an interrupted run or a second run writing the same
+    # period never leaves a truncated file under the final name.
+    os.makedirs(SWARM_CACHE_DIR, exist_ok=True)
+    tmp_file = cache_file+'.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+    pd.to_pickle((dsA, dsB, dsC), tmp_file)
+    os.replace(tmp_file, cache_file)
 
     return dsA, dsB, dsC
 
+# 1b. Get the Swarm Data and Residuals for every day of the trajectory: Get_Swarm_residuals_dates
+# Runs of consecutive days (up to SWARM_BATCH_DAYS) go in a single request, so short trajectories do not pay
+# one round trip per day. The runs are downloaded a few at a time (max_workers), each Get_Swarm_residuals call
+# already sends its three satellite requests at the same time. Whatever max_workers is, at most SWARM_MAX_REQUESTS
+# requests are sent to VirES at once (i.e two periods with the default of 6).
+# Input:  list of dates
+# Output: three lists (Sat A, B, C) with one Swarm DF per run of days, in the order of the dates.
+
+def Get_Swarm_residuals_dates(dates, max_workers=4):
+    
+    hours_t_day = 24 #MagGeo needs the entire Swarm data for each day of the identified day.
+    hours_added = timedelta(hours = hours_t_day)
+    
+    #1. Group the sorted dates in runs of consecutive days.
+    runs = []
+    for d in sorted(dates):
+        if runs and (d - runs[-1][-1]).days == 1 and len(runs[-1]) < SWARM_BATCH_DAYS:
+            runs[-1].append(d)
+        else:
+            runs.append([d])
+    
+    def get_run(run):
+        print("Getting Swarm data for dates:",run[0],"to",run[-1] )
+        startdate = datetime.combine(run[0], datetime.min.time())
+        return Get_Swarm_residuals(startdate, startdate + len(run)*hours_added)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        days = list(executor.map(get_run, runs))
+    listdfa = [day[0] for day in days]
+    listdfb = [day[1] for day in days]
+    listdfc = [day[2] for day in days]
+    return listdfa, listdfb, listdfc
+
+# Half width of the ST-IDW time window, 4 hours in seconds.
+ST_IDW_DT = 14400
+# Columns of the rows returned by ST_IDW_Process, in order.
+ST_IDW_COLUMNS = ['Latitude', 'Longitude', 'Altitude', 'DateTime', 'N_res', 'E_res', 'C_res', 'TotalPoints', 'Minimum_Distance', 'Average_Distance', 'Kp']
+
 # 2. Filter Space and time ST-IDW based on GPS points. ST_IDW_Process
 # Interpolation of the Swarm Residuals., NEC interpolated residuals for each GPS Point. Quality flags filters.
 # Input:  GPS Track columns, SwarmDataDF
@@ -173,17 +251,18 @@ def Get_Swarm_residuals(startDateTime, endDateTime):
 
 def ST_IDW_Process (GPSLat,GPSLong,GPSAltitude,GPSDateTime,GPSTime, TotalSwarmRes_A,TotalSwarmRes_B, TotalSwarmRes_C):
     
-    DT=14400 #4 hours in seconds.
+    DT=ST_IDW_DT #4 hours in seconds.
     # 1. Runnig the DfTime_func function to filter by the defined DeltaTime.
     time_kernel_A = DfTime_func(TotalSwarmRes_A,GPSTime,DT)
     time_kernel_B = DfTime_func(TotalSwarmRes_B,GPSTime,DT)
     time_kernel_C = DfTime_func(TotalSwarmRes_C,GPSTime,DT)
     
-    #2. Computing the dt as the difference between the datetime and the datetime from swarm point. At this point
-    # We have filtered the swarm point by time.
-    time_kernel_A['dT'] = (GPSTime - (time_kernel_A.index))
-    time_kernel_B['dT'] = (GPSTime - (time_kernel_B.index))
-    time_kernel_C['dT'] = (GPSTime - (time_kernel_C.index))
+    #1b. Bad points (GPS epoch not found in the Swarm data, or a pole where Kradius is not defined) get an empty row, so the
+    # callers don't need a try/except around every point. The NaN row with TotalPoints=0 marks the point, as in ST_IDW_Process_batch.
+    if len(time_kernel_A) == 0 or len(time_kernel_B) == 0 or len(time_kernel_C) == 0 or not -90 < GPSLat < 90:
+        return {'Latitude': GPSLat, 'Longitude': GPSLong, 'Altitude':GPSAltitude, 'DateTime': GPSDateTime, 'N_res': np.nan, 'E_res': np.nan, 'C_res':np.nan, 'TotalPoints':0, 'Minimum_Distance':np.nan, 'Average_Distance':np.nan, 'Kp':np.nan}
+    
+    #2. The dt between the GPS point and each swarm point is computed in step 10, only for the points that pass the filters.
     
     #3.Computing the ds
     ### Parsing the requieres parameters for distance_to_GPS function
@@ -194,95 +273,211 @@ def ST_IDW_Process (GPSLat,GPSLong,GPSAltitude,GPSDateTime,GPSTime, TotalSwarmRe
     s_lat = GPSLat; e_lat = time_kernel_C['Latitude']; s_lng = GPSLong; e_lng = time_kernel_C['Longitude']  
     time_kernel_C['distance']= distance_to_GPS(s_lat, s_lng, e_lat, e_lng)
    
-    #4. Computing the R distance.
-    time_kernel_A['r']= Kradius(GPSLat)
-    time_kernel_B['r']= Kradius(GPSLat)
-    time_kernel_C['r']= Kradius(GPSLat)
+    #4. Computing the R distance, once for the GPS point. It is a scalar, so no r column is added to the DFs.
+    r = Kradius(GPSLat)
     
-    #5. Filtering rows that only fall into the computed R value.
-    space_time_kA=time_kernel_A[time_kernel_A['distance']<=time_kernel_A['r']]
-    space_time_kB=time_kernel_B[time_kernel_B['distance']<=time_kernel_B['r']]
-    space_time_kC=time_kernel_C[time_kernel_C['distance']<=time_kernel_C['r']]
+    #5. Rows that only fall into the computed R value.
+    in_r_A = time_kernel_A['distance']<=r
+    in_r_B = time_kernel_B['distance']<=r
+    in_r_C = time_kernel_C['distance']<=r
     
-    ###6. Filtering Bad Points, using quality flags
-    space_time_kA_res = space_time_kA[space_time_kA['F_res'].between(-2000, 2000)]
-    space_time_kA_flag_F = space_time_kA_res[space_time_kA_res['Flags_F'].between(0, 1)]
-    space_time_kA_res_flags = space_time_kA_flag_F[space_time_kA_flag_F['Flags_B'].between(0, 1)]
-
-    space_time_kB_res = space_time_kB[space_time_kB['F_res'].between(-2000, 2000)]
-    space_time_kB_flag_F = space_time_kB_res[space_time_kB_res['Flags_F'].between(0, 1)]
-    space_time_kB_res_flags = space_time_kB_flag_F[space_time_kB_flag_F['Flags_B'].between(0, 1)]
-
-    space_time_kC_res = space_time_kC[space_time_kC['F_res'].between(-2000, 2000)]
-    space_time_kC_flag_F = space_time_kC_res[space_time_kC_res['Flags_F'].between(0, 1)]
-    space_time_kC_res_flags = space_time_kC_flag_F[space_time_kC_flag_F['Flags_B'].between(0, 1)]
+    ###6. Filtering Bad Points, using quality flags. Combined with the R mask, so each satellite is sliced only once.
+    space_time_kA_res_flags = time_kernel_A[in_r_A & time_kernel_A['F_res'].between(-2000, 2000) & time_kernel_A['Flags_F'].between(0, 1) & time_kernel_A['Flags_B'].between(0, 1)]
+    space_time_kB_res_flags = time_kernel_B[in_r_B & time_kernel_B['F_res'].between(-2000, 2000) & time_kernel_B['Flags_F'].between(0, 1) & time_kernel_B['Flags_B'].between(0, 1)]
+    space_time_kC_res_flags = time_kernel_C[in_r_C & time_kernel_C['F_res'].between(-2000, 2000) & time_kernel_C['Flags_F'].between(0, 1) & time_kernel_C['Flags_B'].between(0, 1)]
     
     #7. Calculating the number of points per satellite that have passed the Space and Time Windows.
     TolSatPts = (len(space_time_kA_res_flags.index)+len(space_time_kB_res_flags.index)+len(space_time_kC_res_flags.index))
     
-    #8. Combining the three satellited messures into a bigger dataframe that store all the Swarm points that were filtered. 
-    frames = [space_time_kA_res_flags, space_time_kB_res_flags, space_time_kC_res_flags] #List to index the specific SatId to the new full DF.
-    SwarmResiduals_ST_filtered = pd.concat(frames, keys=['A', 'B','C'], sort=False)
+    #8. Combining the three satellited messures. Only the columns used below are stacked, as plain arrays, so no combined
+    # DF (and no A/B/C MultiIndex) is built for every GPS point.
+    frames = [space_time_kA_res_flags, space_time_kB_res_flags, space_time_kC_res_flags]
+    def stack(column):
+        return np.concatenate([frame[column].to_numpy() for frame in frames])
+    ds = stack('distance')
     
-    #9. Computing the minimum and average distance and the Kp index average.
-    MinDistance = SwarmResiduals_ST_filtered['distance'].min()
-    AvDistance = SwarmResiduals_ST_filtered['distance'].mean()
-    kp_Avg = SwarmResiduals_ST_filtered['Kp'].mean()
+    #9. Computing the minimum and average distance and the Kp index average. NaN when no Swarm point passed the filters.
+    MinDistance = ds.min() if TolSatPts else np.nan
+    AvDistance = ds.mean() if TolSatPts else np.nan
+    kp_Avg = np.nanmean(stack('Kp')) if TolSatPts else np.nan
     
-    #10. Computing the d (hypotenuse compused from the edges ds, dt values
-    ds = SwarmResiduals_ST_filtered['distance']
-    r = SwarmResiduals_ST_filtered['r']
-    dt = SwarmResiduals_ST_filtered['dT']
-    SwarmResiduals_ST_filtered['Dj']= DistJ(ds, r, dt, DT)
+    #10. Computing the d (hypotenuse compused from the edges ds, dt values. Steps 10 to 14 work on the raw arrays of the
+    # filtered points.
+    # dt is the difference between the GPS epoch and the epoch of each swarm point, both int64 seconds, so it is a
+    # single integer subtraction on the stacked index, no dT column is added to the DFs.
+    dt = GPSTime - np.concatenate([frame.index.to_numpy() for frame in frames])
    
-    #11. Calculating the weigth values based on the previuos parameters.
-    SwarmResiduals_ST_filtered['W']= 1/((SwarmResiduals_ST_filtered['Dj'])**2) #We need to make more clear this part.
+    #11. Calculating the weigth values based on the previuos parameters. W = 1/Dj**2, where Dj = sqrt(((ds/r)**2 + (dt/DT)**2)/2)
+    # is the hypotenuse of the ds, dt edges. Dj**2 is written out, so no square root is taken only to be squared again.
+    W = 2/((ds/r)**2 + (dt/DT)**2)
     
     #12. Computing the Sum of weigths
-    SumW = SwarmResiduals_ST_filtered['W'].sum()
+    SumW = np.nansum(W)
     
     #13. Distribution of weigths
-    SwarmResiduals_ST_filtered['Wj'] = SwarmResiduals_ST_filtered['W']/SumW 
+    Wj = W/SumW 
     
     #14. Computing the Magnetic componente based on the weigths prevoius weigths. 
-    N_res_int = (SwarmResiduals_ST_filtered['Wj']*SwarmResiduals_ST_filtered['N_res']).sum()
-    E_res_int = (SwarmResiduals_ST_filtered['Wj']*SwarmResiduals_ST_filtered['E_res']).sum()
-    C_res_int = (SwarmResiduals_ST_filtered['Wj']*SwarmResiduals_ST_filtered['C_res']).sum()
+    N_res_int = np.nansum(Wj*stack('N_res'))
+    E_res_int = np.nansum(Wj*stack('E_res'))
+    C_res_int = np.nansum(Wj*stack('C_res'))
 
     #15. Write the results into an array that will be a dictionay for the final dataframe.
     resultrowGPS = {'Latitude': GPSLat, 'Longitude': GPSLong, 'Altitude': GPSAltitude, 'DateTime': GPSDateTime, 'N_res': N_res_int, 'E_res': E_res_int, 'C_res':C_res_int, 'TotalPoints':TolSatPts, 'Minimum_Distance':MinDistance, 'Average_Distance':AvDistance, 'Kp':kp_Avg}  
     return resultrowGPS
 
+# 2b. Batch version of the ST-IDW process for a whole chunk of GPS points. ST_IDW_Process_batch
+# The Swarm DFs are unpacked into plain arrays (SwarmArrays) only once, then each GPS point finds its time window with
+# a binary search over the (sorted) epoch index instead of scanning the whole DF.
+# Input:  GPS Track columns as arrays, SwarmArrays (or SwarmDataDF) for each satellite
+# Output: DF with one row per GPS point and the same columns returned by ST_IDW_Process
+
+SwarmArrays = namedtuple('SwarmArrays', 'epoch lat_rad lng_rad cos_lat N_res E_res C_res Kp good')
+
+def Swarm_arrays(SwarmData):
+    if not SwarmData.index.is_monotonic_increasing:
+        SwarmData = SwarmData.sort_index()
+    # float32 as in Get_Swarm_residuals (SWARM_FLOAT_COLUMNS), the weights and the interpolated values are still summed in float64.
+    lat_rad = np.deg2rad(SwarmData['Latitude'].to_numpy(dtype=np.float32))
+    return SwarmArrays(
+        epoch = SwarmData.index.to_numpy(),
+        # The Swarm side of the haversine only depends on the Swarm point, so it is done once here.
+        lat_rad = lat_rad,
+        lng_rad = np.deg2rad(SwarmData['Longitude'].to_numpy(dtype=np.float32)),
+        cos_lat = np.cos(lat_rad),
+        N_res = SwarmData['N_res'].to_numpy(dtype=np.float32),
+        E_res = SwarmData['E_res'].to_numpy(dtype=np.float32),
+        C_res = SwarmData['C_res'].to_numpy(dtype=np.float32),
+        Kp = SwarmData['Kp'].to_numpy(dtype=np.float32),
+        # Quality flags are evaluated once rather than once per GPS point.
+        good = (SwarmData['F_res'].between(-2000, 2000) & SwarmData['Flags_F'].between(0, 1) & SwarmData['Flags_B'].between(0, 1)).to_numpy())
+
+# Cut a SwarmArrays to the points with epoch in [t_min, t_max]. The fields are slices (views) of the sorted arrays, nothing is copied.
+def Swarm_arrays_window(SwarmData, t_min, t_max):
+    lo = np.searchsorted(SwarmData.epoch, t_min, side='left')
+    hi = np.searchsorted(SwarmData.epoch, t_max, side='right')
+    return SwarmArrays(*(field[lo:hi] for field in SwarmData))
+
+def ST_IDW_Process_batch(GPSLat, GPSLong, GPSAltitude, GPSDateTime, GPSTime, TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C):
+    
+    DT=ST_IDW_DT #4 hours in seconds.
+    GPSTime = np.asarray(GPSTime)
+    n_points = len(GPSTime)
+    
+    #1. Unpack the Swarm DFs, unless the caller already passes the SwarmArrays.
+    swarm = [TotalSwarmRes if isinstance(TotalSwarmRes, SwarmArrays) else Swarm_arrays(TotalSwarmRes) for TotalSwarmRes in (TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C)]
+    
+    #2. Output columns, points without valid Swarm data keep NaN and 0 TotalPoints.
+    N_res_int = np.full(n_points, np.nan)
+    E_res_int = np.full(n_points, np.nan)
+    C_res_int = np.full(n_points, np.nan)
+    MinDistance = np.full(n_points, np.nan)
+    AvDistance = np.full(n_points, np.nan)
+    kp_Avg = np.full(n_points, np.nan)
+    TolSatPts = np.zeros(n_points, dtype=int)
+    
+    for i in range(n_points):
+        lat = GPSLat[i]; lng = GPSLong[i]; t = GPSTime[i]
+        #3. Kradius is only defined strictly between the poles.
+        if not -90 < lat < 90:
+            continue
+        r = Kradius(lat)
+        lat_rad = np.deg2rad(lat); lng_rad = np.deg2rad(lng)
+        ds, dt, N_res, E_res, C_res, Kp = [], [], [], [], [], []
+        has_gps_time = True
+        for sat in swarm:
+            epochs = sat.epoch
+            #4. As in DfTime_func, the GPS epoch must be one of the Swarm epochs of every satellite.
+            match = np.searchsorted(epochs, t, side='left')
+            if match == len(epochs) or epochs[match] != t:
+                has_gps_time = False
+                break
+            lo = np.searchsorted(epochs, t-DT, side='left')
+            hi = np.searchsorted(epochs, t+DT, side='right')
+            #5. Space filter (distance <= R) combined with the quality flags.
+            distance = distance_to_GPS_rad(lat_rad, lng_rad, sat.lat_rad[lo:hi], sat.lng_rad[lo:hi], sat.cos_lat[lo:hi])
+            keep = (distance <= r) & sat.good[lo:hi]
+            ds.append(distance[keep])
+            dt.append(t - epochs[lo:hi][keep])
+            N_res.append(sat.N_res[lo:hi][keep])
+            E_res.append(sat.E_res[lo:hi][keep])
+            C_res.append(sat.C_res[lo:hi][keep])
+            Kp.append(sat.Kp[lo:hi][keep])
+        if not has_gps_time:
+            continue
+        ds = np.concatenate(ds)
+        TolSatPts[i] = len(ds)
+        if TolSatPts[i] == 0:
+            N_res_int[i] = E_res_int[i] = C_res_int[i] = 0.0
+            continue
+        #6. Same weighting as ST_IDW_Process, computed on the arrays of the filtered points.
+        W = 2/((ds/r)**2 + (np.concatenate(dt)/DT)**2)
+        Wj = W/W.sum()
+        N_res_int[i] = np.nansum(Wj*np.concatenate(N_res))
+        E_res_int[i] = np.nansum(Wj*np.concatenate(E_res))
+        C_res_int[i] = np.nansum(Wj*np.concatenate(C_res))
+        MinDistance[i] = ds.min()
+        AvDistance[i] = ds.mean()
+        kp_Avg[i] = np.nanmean(np.concatenate(Kp))
+    
+    return pd.DataFrame({'Latitude': GPSLat, 'Longitude': GPSLong, 'Altitude': GPSAltitude, 'DateTime': GPSDateTime, 'N_res': N_res_int, 'E_res': E_res_int, 'C_res':C_res_int, 'TotalPoints':TolSatPts, 'Minimum_Distance':MinDistance, 'Average_Distance':AvDistance, 'Kp':kp_Avg})
+
+# 3. Compute the NEC values at the GPS altitude with the CHAOS model. CHAOS_ground_values
+# The local CHAOS model in mat format is parsed once per process by get_CHAOS_model and reused afterwards.
+# Input:  GPS Track + ResidualsInterpolated
+# Output: N, E, C values at the GPS altitude (geodetic frame)
+
+_CHAOS_model = None
+
+def get_CHAOS_model():
+    global _CHAOS_model
+    if _CHAOS_model is None:
+        _CHAOS_model = load_CHAOS_matfile(r'CHAOS-7.mat')
+    return _CHAOS_model
+
 def CHAOS_ground_values(GPS_ResInt):
     #1. Load the requiered parameters, including a local CHAOS model in mat format.
-    model = load_CHAOS_matfile(r'CHAOS-7.mat')
+    model = get_CHAOS_model()
     theta = 90-GPS_ResInt['Latitude'].values
     phi = GPS_ResInt['Longitude'].values
     alt=GPS_ResInt['Altitude'].values
     rad_geoc_ground, theta_geoc_ground, sd_ground, cd_ground = gg_to_geo(alt, theta) # gg_to_geo, will transfor the coordinates from geocentric values to geodesic values. Altitude must be in km
-    time= mjd2000(pd.DatetimeIndex(GPS_ResInt['DateTime']).year, pd.DatetimeIndex(GPS_ResInt['DateTime']).month, pd.DatetimeIndex(GPS_ResInt['DateTime']).day)
+    dates = pd.DatetimeIndex(GPS_ResInt['DateTime']) # Parsed once for the year, month and day.
+    time= mjd2000(dates.year, dates.month, dates.day)
     
     #2. Compute the core, crust and magentoshpere contributions at the altitude level.
     B_r_core, B_t_core, B_phi_core = model.synth_values_tdep(time, rad_geoc_ground, theta_geoc_ground, phi) #Core Contribution
     B_r_crust, B_t_crust, B_phi_crust = model.synth_values_static(rad_geoc_ground, theta_geoc_ground, phi) #Crust Contribution
     B_r_magneto, B_t_magneto, B_phi_magneto = model.synth_values_gsm(time, rad_geoc_ground, theta_geoc_ground, phi) #Magnetosphere contribution.
 
-    #3. Change the direcction of the axis from XYZ to r,theta and phi.
-    B_r_swarm, B_t_swarm, B_phi_swarm = -GPS_ResInt['C_res'], -GPS_ResInt['N_res'], GPS_ResInt['E_res']
-
-
-    #4. Compute the magnetic component (r,theta,phi) at ground level.
-    B_r_ground = B_r_core + B_r_crust + B_r_magneto + B_r_swarm #(-Z)
-    B_t_ground = B_t_core + B_t_crust + B_t_magneto + B_t_swarm #(-X)
-    B_phi_ground = B_phi_core + B_phi_crust +B_phi_magneto + B_phi_swarm #(Y)
+    #3. Compute the magnetic component (r,theta,phi) at ground level. The crust, magnetosphere and Swarm contributions are
+    # added in place on the core arrays, the Swarm residuals change from XYZ to r,theta and phi on the way (-C, -N, E).
+    B_r_ground, B_t_ground, B_phi_ground = B_r_core, B_t_core, B_phi_core
+    B_r_ground += B_r_crust; B_r_ground += B_r_magneto; B_r_ground -= GPS_ResInt['C_res'].to_numpy() #(-Z)
+    B_t_ground += B_t_crust; B_t_ground += B_t_magneto; B_t_ground -= GPS_ResInt['N_res'].to_numpy() #(-X)
+    B_phi_ground += B_phi_crust; B_phi_ground += B_phi_magneto; B_phi_ground += GPS_ResInt['E_res'].to_numpy() #(Y)
 
-    #5. Convert B_r_, B_t_, and B_phi to XYZ (NEC)
-    Z_chaos = -B_r_ground   #Z
-    X_chaos = -B_t_ground   #X
+    #4. Convert B_r_, B_t_, and B_phi to XYZ (NEC), flipping the signs in place.
+    Z_chaos = np.negative(B_r_ground, out=B_r_ground)   #Z
+    X_chaos = np.negative(B_t_ground, out=B_t_ground)   #X
     Y_chaos = B_phi_ground  #Y
 
-    #6. Rotate the X(N) and Z(C) magnetic field values of the chaos models into the geodectic frame using the sd and cd (sine and cosine d from gg_to_geo) 
-    X_obs = X_chaos*cd_ground + Z_chaos*sd_ground #New N
-    Z_obs = Z_chaos*cd_ground - X_chaos*sd_ground #New C
+    #5. Rotate the X(N) and Z(C) magnetic field values of the chaos models into the geodectic frame using the sd and cd (sine and cosine d from gg_to_geo) 
+    X_obs = X_chaos*cd_ground; X_obs += Z_chaos*sd_ground #New N
+    Z_obs = Z_chaos*cd_ground; Z_obs -= X_chaos*sd_ground #New C
     Y_obs = Y_chaos # New E
-    return X_obs, Y_obs, Z_obs
\ No newline at end of file
+    return X_obs, Y_obs, Z_obs
+
+# 4. Compute the additional magnetic components from the NEC values. magnetic_components
+# Works on the raw arrays, np.hypot gives H and then F = hypot(H, C) without building the squared temporaries.
+# Input:  N, E, C columns
+# Output: H, F in nT and D, I in degrees, as arrays.
+
+def magnetic_components(N, E, C):
+    N = np.asarray(N, dtype=float); E = np.asarray(E, dtype=float); C = np.asarray(C, dtype=float)
+    H = np.hypot(N, E)
+    #check the arcgtan in python., From arctan2 is saver.
+    D = np.degrees(np.arctan2(E, N))
+    I = np.degrees(np.arctan2(C, H))
+    F = np.hypot(H, C)
+    return H, D, I, F
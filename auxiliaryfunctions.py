@@ -4,31 +4,34 @@ import pandas as pd
 def distance_to_GPS(s_lat, s_lng, e_lat, e_lng): 
     # approximate radius of earth in km
     R = 6373.0
-    s_lat = s_lat*(np.pi)/180.0                     
-    s_lng = np.deg2rad(s_lng)     
-    e_lat = np.deg2rad(e_lat)                       
-    e_lng = np.deg2rad(e_lng)
+    # The Swarm coordinates come as pandas Series, work on the raw arrays to avoid building an aligned Series per operation.
+    e_lat = np.deg2rad(np.asarray(e_lat))
+    e_lng = np.deg2rad(np.asarray(e_lng))
+    # The GPS point is a scalar, so its trigonometry is done only once.
+    s_lat = np.deg2rad(s_lat)
+    s_lng = np.deg2rad(s_lng)
     d = np.sin((e_lat - s_lat)/2)**2 + np.cos(s_lat)*np.cos(e_lat) * np.sin((e_lng - s_lng)/2)**2
     return 2 * R * np.arcsin(np.sqrt(d))
 
-def Kradius (lat):
-    if 0 <= lat < 90 :
-        #for Northern Latitudes 
-        nlat = (-10 * lat) + 1800
-        #print("The R on the North")
-    if -90 < lat < 0:
-        #for Southern Latitudes
-        nlat = (10 * lat) + 1800
-        #print ("The R on the South")
-    return nlat
+def distance_to_GPS_rad(s_lat, s_lng, e_lat, e_lng, cos_e_lat):
+    # Same haversine as distance_to_GPS, with every coordinate already in radians and the cosine of the Swarm latitudes
+    # precomputed, so a batch of GPS points can reuse the Swarm trigonometry.
+    R = 6373.0
+    d = np.sin((e_lat - s_lat)/2)**2 + np.cos(s_lat)*cos_e_lat * np.sin((e_lng - s_lng)/2)**2
+    return 2 * R * np.arcsin(np.sqrt(d))
 
-def DistJ(ds, r, dt, DT):
-    eDist = np.sqrt(((ds/r)**2 + (dt/DT)**2)/2)
-    return eDist
+def Kradius (lat):
+    # -10*lat + 1800 for Northern Latitudes and 10*lat + 1800 for Southern Latitudes, written without branches so it also
+    # works on arrays. Only defined strictly between the poles, the callers skip points at +/-90.
+    return 1800 - 10 * np.abs(lat)
 
 def DfTime_func (SwarmData, GPSTime, DT):
-    DataFrame_Per_Time = []
-    for index in SwarmData.index:
-        if index == GPSTime:
-            DataFrame_Per_Time = pd.DataFrame(SwarmData.loc[index-DT:index+DT])    
-    return DataFrame_Per_Time
\ No newline at end of file
+    # The Swarm DFs are indexed by epoch in time order, so the GPS epoch and its +/- DT window are found with a binary
+    # search instead of a scan over the whole index.
+    if not SwarmData.index.is_monotonic_increasing:
+        SwarmData = SwarmData.sort_index()
+    epochs = SwarmData.index.to_numpy()
+    match = np.searchsorted(epochs, GPSTime, side='left')
+    if match == len(epochs) or epochs[match] != GPSTime:
+        return []
+    return pd.DataFrame(SwarmData.iloc[np.searchsorted(epochs, GPSTime-DT, side='left'):np.searchsorted(epochs, GPSTime+DT, side='right')])
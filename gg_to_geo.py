@@ -42,9 +42,11 @@ def gg_to_geo(h, gdcolat):
 
     plrad = eqrad*(1-flat) # polar radius
 
-    ctgd = np.cos(np.deg2rad(gdcolat))
+    gdcolat_rad = np.deg2rad(gdcolat) # converted once for both the cosine and the sine
 
-    stgd = np.sin(np.deg2rad(gdcolat))
+    ctgd = np.cos(gdcolat_rad)
+
+    stgd = np.sin(gdcolat_rad)
 
     a2 = eqrad*eqrad
 
@@ -58,9 +60,11 @@ def gg_to_geo(h, gdcolat):
 
     s2 = 1-c2
 
-    rho = np.sqrt(a2*s2 + b2*c2)
+    rho2 = a2*s2 + b2*c2
+
+    rho = np.sqrt(rho2)
 
-    rad = np.sqrt(h*(h+2*rho) + (a4*s2+b4*c2)/rho**2)
+    rad = np.sqrt(h*(h+2*rho) + (a4*s2+b4*c2)/rho2)
 
     cd = (h+rho)/rad
 
@@ -1,40 +1,84 @@
 import pandas as pd
 import numpy as np
 import os
-from MagGeoFunctions import ST_IDW_Process
+from multiprocessing import shared_memory
+from MagGeoFunctions import ST_IDW_Process_batch, Swarm_arrays, Swarm_arrays_window, SWARM_FLOAT_COLUMNS, ST_IDW_DT
 from MagGeoFunctions import CHAOS_ground_values
+from MagGeoFunctions import get_CHAOS_model
 
-TotalSwarmRes_A = pd.read_csv(r'./temp_data/TotalSwarmRes_A.csv',low_memory=False, index_col='epoch')
-TotalSwarmRes_A['timestamp'] = pd.to_datetime(TotalSwarmRes_A['timestamp'])
-TotalSwarmRes_B = pd.read_csv(r'./temp_data/TotalSwarmRes_B.csv',low_memory=False, index_col='epoch')
-TotalSwarmRes_B['timestamp'] = pd.to_datetime(TotalSwarmRes_B['timestamp'])
-TotalSwarmRes_C = pd.read_csv(r'./temp_data/TotalSwarmRes_C.csv',low_memory=False, index_col='epoch')
-TotalSwarmRes_C['timestamp'] = pd.to_datetime(TotalSwarmRes_C['timestamp'])
+# The Swarm data, as the SwarmArrays used by ST_IDW_Process_batch, is set by init_worker in the pool workers. Outside a
+# pool it is read from temp_data the first time row_handler runs, so importing this module does not touch the disk.
+TotalSwarmRes_A = TotalSwarmRes_B = TotalSwarmRes_C = None
+
+# Swarm columns read by ST_IDW_Process_batch. Only these are read from the temp CSVs and placed in shared memory
+# for the pool workers.
+SWARM_SHARED_COLUMNS = ['Latitude', 'Longitude', 'F_res', 'N_res', 'E_res', 'C_res', 'Kp', 'Flags_F', 'Flags_B']
+
+def _load_swarm():
+    SwarmData = []
+    for satellite in ['A', 'B', 'C']:
+        SwarmRes = pd.read_csv(r'./temp_data/TotalSwarmRes_'+satellite+'.csv',low_memory=False, index_col='epoch', usecols=['epoch']+SWARM_SHARED_COLUMNS, dtype={column: np.float32 for column in SWARM_FLOAT_COLUMNS})
+        SwarmData.append(Swarm_arrays(SwarmRes))
+    return SwarmData
+
+_swarm_blocks = []
+
+# Copy the epoch index (int64) and the ST-IDW columns (float32) of each Swarm DF into one shared memory block per satellite.
+# Returns the blocks (to be released by the main process once the pool is closed) and the specs for init_worker.
+def share_swarm_data(*SwarmData):
+    blocks, specs = [], []
+    for SwarmRes in SwarmData:
+        n_rows = len(SwarmRes)
+        block = shared_memory.SharedMemory(create=True, size=max(1, n_rows*8 + n_rows*len(SWARM_SHARED_COLUMNS)*4))
+        np.ndarray((n_rows,), dtype=np.int64, buffer=block.buf)[:] = SwarmRes.index.to_numpy()
+        np.ndarray((n_rows, len(SWARM_SHARED_COLUMNS)), dtype=np.float32, buffer=block.buf, offset=n_rows*8)[:] = SwarmRes[SWARM_SHARED_COLUMNS].to_numpy(dtype=np.float32)
+        blocks.append(block)
+        specs.append((block.name, n_rows))
+    return blocks, specs
+
+def release_swarm_data(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+# Pool initializer, run once by every worker process. Each worker attaches to the shared Swarm blocks and wraps them
+# in DFs without copying, so the Swarm data lives once in memory whatever the number of workers or the start method.
+# The CHAOS model is loaded here as well, so it is parsed once per worker and not once per chunk.
+def init_worker(spec_A, spec_B, spec_C):
+    global TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C, _swarm_blocks
+    _swarm_blocks = [shared_memory.SharedMemory(name=name) for name, n_rows in (spec_A, spec_B, spec_C)]
+    TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C = [Swarm_arrays(
+        pd.DataFrame(np.ndarray((n_rows, len(SWARM_SHARED_COLUMNS)), dtype=np.float32, buffer=block.buf, offset=n_rows*8),
+                     index=pd.Index(np.ndarray((n_rows,), dtype=np.int64, buffer=block.buf), name='epoch', copy=False),
+                     columns=SWARM_SHARED_COLUMNS, copy=False))
+        for block, (name, n_rows) in zip(_swarm_blocks, (spec_A, spec_B, spec_C))]
+    get_CHAOS_model()
+
+# Guided split of the GPS track (as in the OpenMP guided schedule). Each chunk takes the points still to schedule divided
+# by the number of cores, so the chunks get smaller towards the end of the track and a slow chunk late in the run does not
+# keep one core busy while the others are idle.
+def guided_chunks(GPSData, NumCores, min_chunk=10):
+    start = 0
+    n_points = len(GPSData)
+    while start < n_points:
+        size = max(min_chunk, (n_points-start)//NumCores)
+        yield GPSData.iloc[start:start+size]
+        start += size
 
 def row_handler (GPSData):
-    dn = [] ## List used to add all the GPS points with the annotated MAG Data. See the last bullet point of this process        
-    for index, row in GPSData.iterrows():
-        GPSLat = row['gpsLat']
-        GPSLong = row['gpsLong']
-        GPSDateTime = row['gpsDateTime']
-        GPSTime = row['epoch']
-        GPSAltitude = row['gpsAltitude']
-        print("Process for:", index,"Date&Time:",GPSDateTime, "Epoch", GPSTime)
-        try:
-            result=ST_IDW_Process(GPSLat,GPSLong,GPSAltitude, GPSDateTime,GPSTime, TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C)
-            dn.append(result)
-        except:
-            print("Ups!.That was a bad Swarm Point, let's keep working with the next point")
-            result_badPoint= {'Latitude': GPSLat, 'Longitude': GPSLong, 'Altitude':GPSAltitude, 'DateTime': GPSDateTime, 'N_res': np.nan, 'E_res': np.nan, 'C_res':np.nan, 'TotalPoints':0, 'Minimum_Distance':np.nan, 'Average_Distance':np.nan}  
-            dn.append(result_badPoint)
-            continue
-
-    
-    GPS_ResInt = pd.DataFrame(dn)
-    GPS_ResInt.to_csv (r'./temp_data/GPS_ResInt.csv', header=True)
+    global TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C
+    if TotalSwarmRes_A is None:
+        TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C = _load_swarm()
+    GPSTime = GPSData['epoch'].to_numpy()
+    # Each Swarm table is cut to the time span of the chunk (plus the ST-IDW window on both sides), so the per-point
+    # binary search in ST_IDW_Process_batch runs on the chunk's part of the Swarm data only.
+    t_min = GPSTime.min()-ST_IDW_DT; t_max = GPSTime.max()+ST_IDW_DT
+    Swarm_A, Swarm_B, Swarm_C = [Swarm_arrays_window(SwarmData, t_min, t_max) for SwarmData in (TotalSwarmRes_A, TotalSwarmRes_B, TotalSwarmRes_C)]
+    GPS_ResInt = ST_IDW_Process_batch(GPSData['gpsLat'].to_numpy(), GPSData['gpsLong'].to_numpy(), GPSData['gpsAltitude'].to_numpy(),
+                                      GPSData['gpsDateTime'].to_numpy(), GPSTime, Swarm_A, Swarm_B, Swarm_C)
     X_obs, Y_obs, Z_obs =CHAOS_ground_values(GPS_ResInt)
-    GPS_ResInt['N'] =pd.Series(X_obs)
-    GPS_ResInt['E'] =pd.Series(Y_obs)
-    GPS_ResInt['C'] =pd.Series(Z_obs)
+    GPS_ResInt['N'], GPS_ResInt['E'], GPS_ResInt['C'] = X_obs, Y_obs, Z_obs
     GPS_ResInt.drop(columns=['N_res', 'E_res','C_res'], inplace=True)
+    # Keep the index of the GPS points, so the chunks can come back from the pool in any order and still be put in place.
+    GPS_ResInt.index = GPSData.index
     return GPS_ResInt
\ No newline at end of file